@@ -7,6 +7,12 @@ import re
 import math
 import html
 import json
+import ast
+import io
+import itertools
+import threading
+import heapq
+import tempfile
 import google.generativeai as genai
 import altair as alt
 from janome.tokenizer import Tokenizer
@@ -52,6 +58,10 @@ st.markdown("""
     .marker-pos { border-color: #2a9d8f; background: #2a9d8f; } .border-pos { border-left-color: #2a9d8f; }
     .marker-neg { border-color: #e76f51; background: #e76f51; } .border-neg { border-left-color: #e76f51; }
     
+    /* 文ごとの感情スコア */
+    .sentence-strip { display: flex; gap: 1px; height: 6px; margin: 2px 0 8px 0; }
+    .sentence-strip span { flex: 1; border-radius: 1px; background: #ddd; }
+    
     /* チャットエリア */
     .chat-container { border-top: 1px solid #eee; padding-top: 20px; margin-top: 30px; }
 </style>
@@ -72,57 +82,139 @@ COMPOUND_RULES = {
 def get_tokenizer():
     return Tokenizer()
 
+# 辞書ソース (優先度の低い順)。品詞列のない辞書は pos に固定の品詞クラスか POS_ANY を指定する
+DICT_SOURCES = [
+    {'name': 'pn_ja.dic', 'enc': 'shift-jis', 'sep': ':', 'term': 0, 'score': 3, 'pos_col': 2},
+    {'name': 'wago.121808.pn', 'enc': 'utf-8', 'sep': '\t', 'term': 1, 'score': 0, 'pos': '*'},
+    {'name': 'pn.csv.m3.120408.trim', 'enc': 'utf-8', 'sep': '\t', 'term': 0, 'score': 1, 'pos': '名詞'},
+]
+USER_DICT_FILE = 'user_dict.tsv'
+POS_ANY = '*'
+POS_CLASSES = ['名詞', '動詞', '形容詞', '副詞', '連体詞', '感動詞']
+POLARITY_LABELS = {
+    'p': 1.0, 'pos': 1.0, 'positive': 1.0,
+    'n': -1.0, 'neg': -1.0, 'negative': -1.0,
+    'e': 0.0, 'neu': 0.0, 'neutral': 0.0,
+    'ポジ': 1.0, 'ネガ': -1.0,
+}
+BUILTIN_DICT = {'良い': 1.0, '悪い': -1.0, '好き': 1.0, '嫌い': -1.0, '楽しい': 0.9, '退屈': -0.9}
+
+def _find_dict_path(name):
+    return name if os.path.exists(name) else os.path.join('dic', name)
+
+def _parse_polarity(values):
+    # 数値、p/n/e ラベル、「ポジ（評価）」形式をまとめてスコアに変換する
+    s = values.astype(str).str.strip().str.lower()
+    score = pd.to_numeric(s, errors='coerce')
+    score = score.fillna(s.map(POLARITY_LABELS)).fillna(s.str[:2].map(POLARITY_LABELS))
+    return score.fillna(0.0).astype(float)
+
+def _read_dict_layer(d):
+    # 1ソース分を {(基本形, 品詞クラス): スコア} に変換する
+    df = pd.read_csv(_find_dict_path(d['name']), encoding=d['enc'], sep=d['sep'], header=None,
+                     on_bad_lines='skip', dtype=str)
+    cols = [d['term'], d['score']] + ([d['pos_col']] if 'pos_col' in d else [])
+    if len(df.columns) <= max(cols): return None
+    terms = df[d['term']].astype(str).str.strip()
+    scores = _parse_polarity(df[d['score']])
+    pos = df[d['pos_col']].astype(str).str.strip() if 'pos_col' in d else pd.Series(d['pos'], index=df.index)
+    keep = (scores != 0.0) & (terms != '')
+    return dict(zip(zip(terms[keep], pos[keep]), scores[keep]))
+
+def is_valid_user_score(score):
+    # UIの入力範囲と同じく、有限かつ -1〜1 のスコアだけを受け付ける
+    return math.isfinite(score) and -1.0 <= score <= 1.0
+
+def read_user_overlay(path=USER_DICT_FILE):
+    # ユーザー辞書: 「語<TAB>スコア[<TAB>品詞]」形式。# で始まる行は無視。スコア0はその語を無効化する
+    overlay = {}
+    if not os.path.exists(path): return overlay
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if not parts[0].strip() or parts[0].startswith('#') or len(parts) < 2: continue
+            try: score = float(parts[1])
+            except ValueError: continue
+            if not is_valid_user_score(score): continue
+            pos = parts[2].strip() if len(parts) > 2 and parts[2].strip() else POS_ANY
+            overlay[(parts[0].strip(), pos)] = score
+    return overlay
+
+def _rebuild_chain(index):
+    # 参照順 (優先度の高い順) のリストを差し替える。読み取り側は古いか新しいかのどちらかを見る
+    index['chain'] = [index['overlay']] + [layer for _, layer in reversed(index['layers'])]
+
 @st.cache_resource
 def load_sentiment_dictionary():
-    dict_files = [
-        {'name': 'pn_ja.dic', 'enc': 'shift-jis', 'sep': ':', 'cols': [0, 3]},
-        {'name': 'wago.121808.pn', 'enc': 'utf-8', 'sep': '\t', 'cols': [1, 0]},
-        {'name': 'pn.csv.m3.120408.trim', 'enc': 'utf-8', 'sep': '\t', 'cols': [0, 1]}
-    ]
-    dic_data = {}
+    index = {'layers': [], 'overlay': {}, 'overlay_mtime': None, 'chain': [], 'lock': threading.Lock()}
     loaded_files = []
     
-    for d in dict_files:
-        path = d['name']
-        if not os.path.exists(path):
-            path = os.path.join('dic', d['name'])
-        
-        if os.path.exists(path):
-            try:
-                df = pd.read_csv(path, encoding=d['enc'], sep=d['sep'], header=None, on_bad_lines='skip')
-                term_col = d['cols'][0]
-                score_col = d['cols'][1]
-                if len(df.columns) > max(term_col, score_col):
-                    for _, row in df.iterrows():
-                        term = str(row[term_col]).strip()
-                        val = row[score_col]
-                        score = 0.0
-                        if isinstance(val, (int, float)): score = float(val)
-                        elif isinstance(val, str):
-                            val = val.lower().strip()
-                            if val in ['p', 'pos', 'positive']: score = 1.0
-                            elif val in ['n', 'neg', 'negative']: score = -1.0
-                            elif val in ['e', 'neu', 'neutral']: score = 0.0
-                            else:
-                                try: score = float(val)
-                                except: pass
-                        if score != 0.0: dic_data[term] = score
-                    loaded_files.append(d['name'])
-            except: pass
-    if not dic_data:
-        dic_data = {'良い': 1.0, '悪い': -1.0, '好き': 1.0, '嫌い': -1.0, '楽しい': 0.9, '退屈': -0.9}
-    return dic_data, loaded_files
-
-SENTIMENT_DICT, LOADED_DICTS = load_sentiment_dictionary()
+    for d in DICT_SOURCES:
+        if not os.path.exists(_find_dict_path(d['name'])): continue
+        try:
+            layer = _read_dict_layer(d)
+        except Exception:
+            continue
+        if layer:
+            index['layers'].append((d['name'], layer))
+            loaded_files.append(d['name'])
+    if not index['layers']:
+        index['layers'].append(('builtin', {(term, POS_ANY): sc for term, sc in BUILTIN_DICT.items()}))
+    _rebuild_chain(index)
+    return index, loaded_files
 
-def analyze_sentiment_advanced(text):
-    if not text: return 0.0, []
-    text_norm = text.replace("ありません", "ないです")
-    t = get_tokenizer()
-    tokens = list(t.tokenize(text_norm))
-    matched_scores = []
+def reload_user_overlay(index, force=False):
+    # ユーザー辞書が更新されていれば、その層だけを読み直す (基本辞書は再解析しない)
+    try: mtime = os.path.getmtime(USER_DICT_FILE)
+    except OSError: mtime = None
+    if not force and mtime == index['overlay_mtime']: return False
+    with index['lock']:
+        index['overlay'] = read_user_overlay()
+        index['overlay_mtime'] = mtime
+        _rebuild_chain(index)
+    return True
+
+def validate_user_dict_term(term):
+    # read_user_overlay で読み戻せない語 (空 / # 始まり / タブ・改行を含む) はエラーにする
+    term = term.strip()
+    if not term: raise ValueError("語が空です")
+    if term.startswith('#'): raise ValueError("「#」で始まる語は登録できません")
+    if any(ch in term for ch in '\t\r\n'): raise ValueError("タブや改行を含む語は登録できません")
+    return term
+
+def add_user_dict_entry(index, term, score, pos=POS_ANY):
+    # ファイルに追記し、オーバーレイ層へ即時反映する
+    term = validate_user_dict_term(term)
+    if pos != POS_ANY and pos not in POS_CLASSES: raise ValueError(f"未対応の品詞です: {pos}")
+    score = float(score)
+    if not is_valid_user_score(score): raise ValueError("スコアは -1〜1 の数値で指定してください")
+    with index['lock']:
+        with open(USER_DICT_FILE, 'a', encoding='utf-8') as f:
+            f.write(f"{term}\t{score}\t{pos}\n")
+        overlay = dict(index['overlay'])
+        overlay[(term, pos)] = score
+        index['overlay'] = overlay
+        index['overlay_mtime'] = os.path.getmtime(USER_DICT_FILE)
+        _rebuild_chain(index)
+
+def lookup_sentiment(index, base_form, pos):
+    # 優先度の高い層から順に (基本形, 品詞) → (基本形, 任意品詞) を引く。最初に見つかった層の値を採用
+    for layer in index['chain']:
+        score = layer.get((base_form, pos))
+        if score is None: score = layer.get((base_form, POS_ANY))
+        if score is not None:
+            return score if score != 0.0 else None
+    return None
+
+SENTIMENT_INDEX, LOADED_DICTS = load_sentiment_dictionary()
+reload_user_overlay(SENTIMENT_INDEX)
+
+def _score_tokens(tokens, current_boost=1.0):
+    # トークン列を辞書・連語・否定・逆接のルールで採点する
+    # 戻り値: (重み付き合計, 重み合計, calc_log, 逆接ブースト)
+    weighted_sum = 0.0
+    total_weight = 0.0
     calc_log = [] 
-    current_boost = 1.0
     
     i = 0
     while i < len(tokens):
@@ -153,9 +245,10 @@ def analyze_sentiment_advanced(text):
                         reason = "連語"
                         break
         
-        if not found_sentiment and base_form in SENTIMENT_DICT:
-            if pos in ['名詞', '動詞', '形容詞', '副詞', '連体詞', '感動詞']:
-                current_score = float(SENTIMENT_DICT[base_form])
+        if not found_sentiment and pos in POS_CLASSES:
+            dict_score = lookup_sentiment(SENTIMENT_INDEX, base_form, pos)
+            if dict_score is not None:
+                current_score = float(dict_score)
                 found_sentiment = True
                 reason = "辞書"
         
@@ -172,17 +265,101 @@ def analyze_sentiment_advanced(text):
                 reason += f" ➡ 否定「{neg_term}」"
             
             final_weight = 1.0 * current_boost
-            matched_scores.append({'score': current_score, 'weight': final_weight})
+            weighted_sum += current_score * final_weight
+            total_weight += final_weight
             calc_log.append({'term': matched_term, 'score': current_score, 'reason': reason, 'weight': final_weight, 'boost': current_boost})
             
         i += 1
+    return weighted_sum, total_weight, calc_log, current_boost
+
+def analyze_sentiment_advanced(text):
+    if not text: return 0.0, []
+    text_norm = text.replace("ありません", "ないです")
+    t = get_tokenizer()
+    tokens = list(t.tokenize(text_norm))
+    weighted_sum, total_weight, calc_log, _ = _score_tokens(tokens)
         
-    if not matched_scores: return 0.0, calc_log
-    weighted_sum = sum(item['score'] * item['weight'] for item in matched_scores)
-    total_weight = sum(item['weight'] for item in matched_scores)
-    final_score = weighted_sum / total_weight if total_weight > 0 else 0.0
+    if total_weight <= 0: return 0.0, calc_log
+    final_score = weighted_sum / total_weight
     return max(-1.0, min(1.0, final_score)), calc_log
 
+# --- 長文向けストリーミング解析 (文単位) ---
+
+SENTENCE_RE = re.compile(r'[^。！？!?\n]*[。！？!?\n]+|[^。！？!?\n]+$')
+SENTENCE_MAX_CHARS = 200
+SENTENCE_CURVE_MAX_POINTS = 200
+CALC_LOG_MAX_TERMS = 50
+
+def iter_sentences(text, max_chars=SENTENCE_MAX_CHARS):
+    # (開始位置, 終了位置, 文) を順に返す。句点のない長文は max_chars ごとに区切る
+    for m in SENTENCE_RE.finditer(text):
+        seg = m.group()
+        for off in range(0, len(seg), max_chars):
+            piece = seg[off:off + max_chars]
+            if piece.strip():
+                yield m.start() + off, m.start() + off + len(piece), piece
+
+def iter_sentence_scores(text):
+    """
+    文ごとに形態素解析して採点し、{'start', 'end', 'score', 'weight', 'calc_log'} を順に返す。
+    逆接ブーストは次の文へ引き継ぐ。
+    """
+    if not text: return
+    t = get_tokenizer()
+    boost = 1.0
+    for start, end, sentence in iter_sentences(text):
+        tokens = list(t.tokenize(sentence.replace("ありません", "ないです")))
+        weighted_sum, total_weight, calc_log, boost = _score_tokens(tokens, boost)
+        score = max(-1.0, min(1.0, weighted_sum / total_weight)) if total_weight > 0 else 0.0
+        yield {'start': start, 'end': end, 'score': score, 'weight': total_weight,
+               'weighted_sum': weighted_sum, 'calc_log': calc_log}
+
+def _merge_curve_points(a, b):
+    weight = a['weight'] + b['weight']
+    score = (a['score'] * a['weight'] + b['score'] * b['weight']) / weight if weight > 0 else (a['score'] + b['score']) / 2
+    return {'start': a['start'], 'end': b['end'], 'score': score, 'weight': weight}
+
+def analyze_sentiment_streaming(text, max_log_terms=CALC_LOG_MAX_TERMS, max_points=SENTENCE_CURVE_MAX_POINTS):
+    """
+    analyze_sentiment_advanced の文単位版。シーン全体のスコアを逐次合算し、
+    文ごとのスコア曲線 (最大 max_points 点、超えたら隣接点を併合) も返す。
+    calc_log は |score|×weight の大きい上位 max_log_terms 語だけを出現順で残す。
+    """
+    weighted_sum = 0.0
+    total_weight = 0.0
+    log_heap = []  # (重要度, -出現順, エントリ) の最小ヒープ。同点なら先に出た語を残す
+    log_seq = 0
+    curve = []
+    span = 1
+    pending = None
+    pending_n = 0
+    for item in iter_sentence_scores(text):
+        weighted_sum += item['weighted_sum']
+        total_weight += item['weight']
+        for entry in item['calc_log']:
+            if entry.get('weight', 0) <= 0: continue
+            key = (abs(entry['score']) * entry['weight'], -log_seq, entry)
+            log_seq += 1
+            if len(log_heap) < max_log_terms: heapq.heappush(log_heap, key)
+            elif max_log_terms > 0: heapq.heappushpop(log_heap, key)
+
+        point = {'start': item['start'], 'end': item['end'], 'score': item['score'], 'weight': item['weight']}
+        pending = point if pending is None else _merge_curve_points(pending, point)
+        pending_n += 1
+        if pending_n == span:
+            curve.append(pending)
+            pending, pending_n = None, 0
+            if len(curve) > max_points:
+                curve = [_merge_curve_points(curve[k], curve[k + 1]) if k + 1 < len(curve) else curve[k]
+                         for k in range(0, len(curve), 2)]
+                span *= 2
+    if pending is not None: curve.append(pending)
+
+    final_score = max(-1.0, min(1.0, weighted_sum / total_weight)) if total_weight > 0 else 0.0
+    calc_log = [entry for _, _, entry in sorted(log_heap, key=lambda k: -k[1])]
+    sentence_scores = [{'start': p['start'], 'end': p['end'], 'score': round(p['score'], 3)} for p in curve]
+    return final_score, calc_log, sentence_scores
+
 # =========================================================
 # 2. ステート & AI知識ベース (詳細版復元)
 # =========================================================
@@ -195,8 +372,15 @@ if 'analyzed_notes' not in st.session_state: st.session_state.analyzed_notes = [
 if 'gemini_api_key' not in st.session_state: st.session_state.gemini_api_key = ""
 if 'chat_history' not in st.session_state: st.session_state.chat_history = []
 if 'chat_initialized' not in st.session_state: st.session_state.chat_initialized = False
-if 'compare_data' not in st.session_state: st.session_state.compare_data = None
-if 'compare_title' not in st.session_state: st.session_state.compare_title = ""
+if 'compare_logs' not in st.session_state: st.session_state.compare_logs = {}
+if 'compare_uploader_gen' not in st.session_state: st.session_state.compare_uploader_gen = 0
+if 'subtitle_uploader_gen' not in st.session_state: st.session_state.subtitle_uploader_gen = 0
+if 'local_scorer' not in st.session_state: st.session_state.local_scorer = None
+if 'local_scorer_report' not in st.session_state: st.session_state.local_scorer_report = None
+if 'local_scorer_enabled' not in st.session_state: st.session_state.local_scorer_enabled = False
+if 'local_threshold' not in st.session_state: st.session_state.local_threshold = 0.8
+if 'report_cache' not in st.session_state: st.session_state.report_cache = None
+if 'notes_version' not in st.session_state: st.session_state.notes_version = 0
 
 # ユーザー提供の物語論を体系化した知識ベース (詳細版)
 # AIの「脳内」にはこの知識を持たせるが、出力時は噛み砕かせる
@@ -288,14 +472,179 @@ def get_safe_text(response):
             pass
     return ""
 
+# --- ローカル推定 (辞書特徴量 → user_score / story_score) ---
+
+LOCAL_COMMENT_PREFIX = "ローカル推定"
+# LLMのスコアが得られていない行 (学習には使わない)
+FALLBACK_COMMENTS = ["API未設定", "AI応答なし", "解析エラー"]
+LOCAL_MIN_TRAIN_ROWS = 8
+LOCAL_RIDGE_LAMBDA = 1.0
+LOCAL_CV_FOLDS = 5
+
+def parse_logged_list(val):
+    # CSV経由で文字列化されたリスト列 (calc_log等) を復元する
+    if isinstance(val, list): return val
+    if isinstance(val, str) and val.startswith('['):
+        try:
+            parsed = ast.literal_eval(val)
+            if isinstance(parsed, list): return parsed
+        except (ValueError, SyntaxError):
+            pass
+    return None
+
+def extract_local_features(dict_score, calc_log):
+    """
+    辞書判定の結果から特徴量ベクトルと「判定の明瞭さ」(0〜1)を作る
+    """
+    matched = [c for c in calc_log if c.get('weight', 0) > 0]
+    scores = np.array([float(c.get('score', 0.0)) for c in matched])
+    n = len(scores)
+    if n:
+        n_pos = int((scores > 0).sum())
+        n_neg = int((scores < 0).sum())
+        agreement = abs(n_pos - n_neg) / n
+        mean_abs = float(np.abs(scores).mean())
+        neg_ratio = sum('否定' in c.get('reason', '') for c in matched) / n
+        compound_ratio = sum(c.get('reason', '').startswith('連語') for c in matched) / n
+    else:
+        agreement = mean_abs = neg_ratio = compound_ratio = 0.0
+    boosted = float(any(c.get('boost', 1.0) > 1.0 for c in calc_log))
+    coverage = 1.0 - math.exp(-n / 3.0)
+
+    features = np.array([
+        dict_score, dict_score * agreement, agreement, coverage,
+        mean_abs, boosted, neg_ratio, compound_ratio
+    ], dtype=float)
+    clarity = agreement * coverage * min(1.0, mean_abs)
+    return features, clarity
+
+def _ridge_fit(X, Y, lam):
+    # 標準化 + バイアス項付きのリッジ回帰 (閉形式)
+    mu = X.mean(axis=0)
+    sd = X.std(axis=0)
+    sd[sd == 0] = 1.0
+    Xb = np.hstack([np.ones((len(X), 1)), (X - mu) / sd])
+    reg = lam * np.eye(Xb.shape[1])
+    reg[0, 0] = 0.0
+    W = np.linalg.solve(Xb.T @ Xb + reg, Xb.T @ Y)
+    return {'mu': mu, 'sd': sd, 'W': W}
+
+def _ridge_predict(params, X):
+    Xb = np.hstack([np.ones((len(X), 1)), (X - params['mu']) / params['sd']])
+    return Xb @ params['W']
+
+def _kfold_ids(n, n_folds=LOCAL_CV_FOLDS):
+    # 各行の fold 番号 (行数が少なければ fold 数を行数まで減らす)
+    folds = np.arange(n) % min(n_folds, n)
+    np.random.default_rng(0).shuffle(folds)
+    return folds
+
+def _out_of_fold_scores(X, Y, lam):
+    # 各行を、その行を含まないデータで学習したモデルで予測する
+    folds = _kfold_ids(len(X))
+    pred = np.zeros_like(Y, dtype=float)
+    for k in np.unique(folds):
+        test = folds == k
+        pred[test] = _ridge_predict(_ridge_fit(X[~test], Y[~test], lam), X[test])
+    return pred
+
+def fit_local_scorer(X, Y, clarity, lam=LOCAL_RIDGE_LAMBDA):
+    """
+    X: 特徴量 (n, f) / Y: LLMスコア (n, 2) = [user_score, story_score]
+    予測モデルに加え、予測誤差の大きさを推定するモデルも学習し信頼度に使う
+    (誤差モデルは交差検証の予測誤差で学習し、学習データへの過適合で誤差を甘く見積もらないようにする)
+    """
+    score_model = _ridge_fit(X, Y, lam)
+    abs_err = np.abs(np.clip(_out_of_fold_scores(X, Y, lam), -1.0, 1.0) - Y).mean(axis=1, keepdims=True)
+    Xe = np.hstack([X, clarity[:, None]])
+    err_model = _ridge_fit(Xe, abs_err, lam)
+    return {'score': score_model, 'error': err_model, 'n_train': len(X)}
+
+def predict_local_scores(scorer, X, clarity):
+    pred = np.clip(_ridge_predict(scorer['score'], X), -1.0, 1.0)
+    Xe = np.hstack([X, clarity[:, None]])
+    est_err = np.clip(_ridge_predict(scorer['error'], Xe)[:, 0], 0.0, 2.0)
+    confidence = clarity * (1.0 - est_err / 2.0)
+    return pred, confidence
+
+def build_local_training_set(df_logs):
+    # エクスポート済みログからLLMスコア付きの行だけを取り出す
+    X_rows, Y_rows, clarity_rows = [], [], []
+    for row in df_logs.to_dict('records'):
+        comment = str(row.get('comment', '')) if pd.notna(row.get('comment', '')) else ''
+        if comment in FALLBACK_COMMENTS or comment.startswith("エラー") or comment.startswith(LOCAL_COMMENT_PREFIX):
+            continue
+        try:
+            user_sc = float(row['sentiment'])
+            story_sc = float(row['story_score'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if not (np.isfinite(user_sc) and np.isfinite(story_sc)): continue
+
+        calc_log = parse_logged_list(row.get('calc_log'))
+        dict_score = row.get('dictionary_score')
+        if calc_log is None or dict_score is None or pd.isna(dict_score):
+            emo_txt = str(row.get('emotion_content', '')) if pd.notna(row.get('emotion_content', '')) else ''
+            dict_score, calc_log = analyze_sentiment_streaming(emo_txt)[:2]
+
+        feats, clarity = extract_local_features(float(dict_score), calc_log)
+        X_rows.append(feats)
+        Y_rows.append([user_sc, story_sc])
+        clarity_rows.append(clarity)
+    if not X_rows:
+        return np.empty((0, 8)), np.empty((0, 2)), np.empty(0)
+    return np.array(X_rows), np.array(Y_rows), np.array(clarity_rows)
+
+def local_scorer_report(X, Y, clarity, thresholds=None):
+    """
+    閾値ごとの「API削減率」と「LLMスコアとの誤差」の一覧
+    (k-fold 交差検証の予測で評価する。k = min(5, 行数))
+    """
+    if thresholds is None: thresholds = np.round(np.arange(0.0, 1.0, 0.1), 1)
+    n = len(X)
+    pred = np.zeros_like(Y, dtype=float)
+    conf = np.zeros(n)
+    folds = _kfold_ids(n)
+    for k in np.unique(folds):
+        test = folds == k
+        scorer = fit_local_scorer(X[~test], Y[~test], clarity[~test])
+        pred[test], conf[test] = predict_local_scores(scorer, X[test], clarity[test])
+
+    abs_err = np.abs(pred - Y)
+    sign_match = np.sign(pred[:, 0]) == np.sign(Y[:, 0])
+    rows = []
+    for th in thresholds:
+        sel = conf >= th
+        k = int(sel.sum())
+        rows.append({
+            "閾値": float(th),
+            "API削減率": k / n if n else 0.0,
+            "ローカル件数": k,
+            "MAE(user)": float(abs_err[sel, 0].mean()) if k else np.nan,
+            "MAE(story)": float(abs_err[sel, 1].mean()) if k else np.nan,
+            "符号一致率(user)": float(sign_match[sel].mean()) if k else np.nan,
+        })
+    return pd.DataFrame(rows)
+
+def predict_scene_locally(scorer, dict_score, calc_log):
+    feats, clarity = extract_local_features(dict_score, calc_log)
+    pred, conf = predict_local_scores(scorer, feats[None, :], np.array([clarity]))
+    return float(pred[0, 0]), float(pred[0, 1]), float(conf[0])
+
 def analyze_scene_with_ai(plot_text, emotion_text):
-    # 辞書判定
-    dict_score, calc_log = analyze_sentiment_advanced(emotion_text)
+    # 辞書判定 (感情メモのみが対象。字幕の台詞スコアは使わない)
+    dict_score, calc_log, sentence_scores = analyze_sentiment_streaming(emotion_text)
     dict_info = f"辞書スコア:{dict_score:.2f}"
-    
+
+    # 辞書結果が明瞭ならローカル推定で済ませ、APIを呼ばない (感情メモが空なら推定しない)
+    if emotion_text and st.session_state.local_scorer is not None and st.session_state.local_scorer_enabled:
+        local_user, local_story, conf = predict_scene_locally(st.session_state.local_scorer, dict_score, calc_log)
+        if conf >= st.session_state.local_threshold:
+            return local_user, local_story, f"{LOCAL_COMMENT_PREFIX} (信頼度 {conf:.2f})", calc_log, dict_score, sentence_scores
+
     api_key = st.session_state.gemini_api_key
     if not api_key:
-        return dict_score, 0.0, "API未設定", "", calc_log, dict_score
+        return dict_score, 0.0, "API未設定", calc_log, dict_score, sentence_scores
 
     try:
         genai.configure(api_key=api_key)
@@ -331,7 +680,7 @@ def analyze_scene_with_ai(plot_text, emotion_text):
         text_content = text_content.replace('```json', '').replace('```', '')
         
         if not text_content:
-             return dict_score, 0.0, "AI応答なし", "", calc_log, dict_score
+             return dict_score, 0.0, "AI応答なし", calc_log, dict_score, sentence_scores
 
         match = re.search(r'\{.*\}', text_content, re.DOTALL)
         if match:
@@ -341,13 +690,14 @@ def analyze_scene_with_ai(plot_text, emotion_text):
                 float(result.get("story_score", 0.0)),
                 result.get("reason", ""),
                 calc_log,
-                dict_score
+                dict_score,
+                sentence_scores
             )
         else:
-            return dict_score, 0.0, "解析エラー", "", calc_log, dict_score
+            return dict_score, 0.0, "解析エラー", calc_log, dict_score, sentence_scores
 
     except Exception as e:
-        return dict_score, 0.0, f"エラー: {str(e)[:20]}", "", calc_log, dict_score
+        return dict_score, 0.0, f"エラー: {str(e)[:20]}", calc_log, dict_score, sentence_scores
 
 def generate_initial_structural_analysis(notes):
     """
@@ -435,66 +785,341 @@ def format_time(seconds):
     h, m = divmod(m, 60)
     return f"{h:d}:{m:02d}:{s:02d}" if h > 0 else f"{m:02d}:{s:02d}"
 
+DECAY_LIFETIME = 60.0
+
+def decay_curve_array(timestamps, scores, duration):
+    # 各秒について直前のイベントからの経過時間を求め、cos減衰をまとめて計算する
+    max_time = int(duration) + 1
+    t_idx = np.asarray(timestamps, dtype=float).astype(int)
+    vals = np.nan_to_num(np.asarray(scores, dtype=float))
+    keep = (t_idx >= 0) & (t_idx < max_time)
+    t_idx, vals = t_idx[keep], vals[keep]
+    if len(t_idx) == 0: return np.zeros(max_time)
+
+    # 同じ秒に複数イベントがあれば後のものを優先
+    order = np.argsort(t_idx, kind='stable')
+    t_idx, vals = t_idx[order], vals[order]
+    last = np.append(t_idx[1:] != t_idx[:-1], True)
+    t_idx, vals = t_idx[last], vals[last]
+
+    grid = np.arange(max_time)
+    pos = np.searchsorted(t_idx, grid, side='right') - 1
+    has_event = pos >= 0
+    delta = np.where(has_event, grid - t_idx[np.maximum(pos, 0)], DECAY_LIFETIME)
+    decay = np.where(delta < DECAY_LIFETIME, np.cos((math.pi/2) * (delta / DECAY_LIFETIME)), 0.0)
+    return np.where(has_event, vals[np.maximum(pos, 0)] * decay, 0.0)
+
 def calculate_decay_curve(df_notes, duration, target_col='sentiment'):
     max_time = int(duration) + 1
-    decay_scores = np.zeros(max_time)
-    
-    events = {}
-    for _, row in df_notes.iterrows():
-        t_idx = int(row['timestamp'])
-        if t_idx < max_time:
-            events[t_idx] = row.get(target_col, 0.0)
-            
-    LIFETIME = 60.0
-    last_t = -999
-    last_s = 0.0
-    
-    for t in range(max_time):
-        if t in events:
-            decay_scores[t] = events[t]
-            last_t = t
-            last_s = events[t]
-        elif last_t != -999:
-            delta = t - last_t
-            if delta < LIFETIME:
-                decay_scores[t] = last_s * math.cos((math.pi/2)*(delta/LIFETIME))
-            else:
-                decay_scores[t] = 0.0
-                last_t = -999
-                last_s = 0.0
-                
+    scores = df_notes[target_col] if target_col in df_notes else np.zeros(len(df_notes))
+    decay_scores = decay_curve_array(df_notes['timestamp'], scores, duration)
     return pd.DataFrame({'timestamp': np.arange(max_time), 'score': decay_scores})
 
-def generate_html_report(df, title):
-    rows_html = ""
-    for _, row in df.sort_values('timestamp').iterrows():
-        score = row['sentiment']
-        
-        border_color = '#2a9d8f' if score >= 0.1 else '#e76f51' if score <= -0.1 else '#ccc'
-        
-        # 安全な文字列取得
-        plot_txt = str(row.get('plot', '')) if pd.notna(row.get('plot', '')) else ''
-        emo_txt = str(row.get('emotion_content', '')) if pd.notna(row.get('emotion_content', '')) else ''
-        comment_txt = str(row.get('comment', '')) if pd.notna(row.get('comment', '')) else ''
-        
-        rows_html += f"""
-        <div style="border-left:4px solid {border_color}; background:#fff; padding:12px; margin-bottom:12px; border-radius:4px; box-shadow:0 1px 3px rgba(0,0,0,0.1);">
+# --- 複数ログの比較 (時間正規化 / DTW整列) ---
+
+COMPARE_GRID_POINTS = 200
+COMPARE_MIN_DURATION = 60
+
+def normalized_curve(df_notes, n_points=COMPARE_GRID_POINTS, target_col='sentiment'):
+    # 作品の長さに関係なく、進行度 0〜100% の共通グリッドに再標本化する
+    duration = max(float(df_notes['timestamp'].max()), COMPARE_MIN_DURATION)
+    scores = df_notes[target_col] if target_col in df_notes else np.zeros(len(df_notes))
+    curve = decay_curve_array(df_notes['timestamp'], scores, duration)
+    grid = np.linspace(0, len(curve) - 1, n_points)
+    return np.interp(grid, np.arange(len(curve)), curve)
+
+def banded_dtw(a, b, band):
+    """
+    Sakoe-Chiba帯付きDTW。反対角線ごとにまとめて更新する。
+    戻り値: (経路に沿った平均距離, 経路のインデックス配列 (ia, ib))
+    """
+    n, m = len(a), len(b)
+    band = max(int(band), abs(n - m))
+    cost = np.abs(a[:, None] - b[None, :])
+    D = np.full((n + 1, m + 1), np.inf)
+    D[0, 0] = 0.0
+    for k in range(2, n + m + 1):
+        i = np.arange(max(1, k - m), min(n, k - 1) + 1)
+        j = k - i
+        in_band = np.abs(i - j) <= band
+        i, j = i[in_band], j[in_band]
+        if len(i) == 0: continue
+        prev = np.minimum(np.minimum(D[i - 1, j], D[i, j - 1]), D[i - 1, j - 1])
+        D[i, j] = cost[i - 1, j - 1] + prev
+
+    # 経路の復元
+    ia, ib = [n - 1], [m - 1]
+    i, j = n, m
+    while i > 1 or j > 1:
+        steps = [(D[i - 1, j - 1], i - 1, j - 1), (D[i - 1, j], i - 1, j), (D[i, j - 1], i, j - 1)]
+        _, i, j = min(steps, key=lambda s: s[0])
+        ia.append(i - 1); ib.append(j - 1)
+    ia, ib = np.array(ia[::-1]), np.array(ib[::-1])
+    return float(cost[ia, ib].mean()), (ia, ib)
+
+def dtw_align(series, reference, band):
+    # 参照曲線の各点に対応する値の平均をとり、参照と同じ長さに揃える
+    dist, (ia, ib) = banded_dtw(series, reference, band)
+    counts = np.bincount(ib, minlength=len(reference))
+    sums = np.bincount(ib, weights=series[ia], minlength=len(reference))
+    return sums / np.maximum(counts, 1), dist
+
+def _safe_corr(a, b):
+    if np.std(a) == 0 or np.std(b) == 0: return np.nan
+    return float(np.corrcoef(a, b)[0, 1])
+
+@st.cache_data(show_spinner=False)
+def compare_log_curves(curves, reference, mode='normalized', band_ratio=0.1):
+    """
+    curves: (ログ数, グリッド点数) の正規化済み曲線 / reference: 基準曲線
+    整列後の曲線・分布バンド・各ログの類似度を返す
+    """
+    if mode == 'dtw':
+        band = int(len(reference) * band_ratio)
+        aligned, dists = [], []
+        for c in curves:
+            a, d = dtw_align(c, reference, band)
+            aligned.append(a); dists.append(d)
+        aligned = np.vstack(aligned)
+        dists = np.array(dists)
+    else:
+        aligned = np.asarray(curves)
+        dists = np.abs(aligned - reference[None, :]).mean(axis=1)
+
+    p10, p25, p50, p75, p90 = np.percentile(aligned, [10, 25, 50, 75, 90], axis=0)
+    bands = pd.DataFrame({
+        'progress': np.linspace(0, 100, aligned.shape[1]),
+        'mean': aligned.mean(axis=0), 'p10': p10, 'p25': p25, 'median': p50, 'p75': p75, 'p90': p90,
+    })
+    similarity = pd.DataFrame({
+        '相関': [_safe_corr(a, reference) for a in aligned],
+        '距離': dists,
+        '類似度': 1.0 - dists / 2.0,
+    })
+    return aligned, bands, similarity
+
+def sentence_strip_html(sentence_scores):
+    # 感情メモの文ごとのスコアを色の帯で表す (2文以上のときのみ)
+    if not sentence_scores or len(sentence_scores) < 2: return ""
+    cells = ""
+    for p in sentence_scores:
+        sc = float(p.get('score', 0.0))
+        color = '#2a9d8f' if sc > 0.1 else '#e76f51' if sc < -0.1 else '#ddd'
+        opacity = 0.35 + 0.65 * min(1.0, abs(sc))
+        cells += f'<span title="{p.get("start", 0)}-{p.get("end", 0)}: {sc:+.2f}" style="background:{color}; opacity:{opacity:.2f};"></span>'
+    return f'<div class="sentence-strip">{cells}</div>'
+
+# --- 字幕・台本の一括取り込み ---
+
+SUBTITLE_CUE_RE = re.compile(
+    r'(?:(\d+):)?(\d{1,2}):(\d{2})[,.](\d{1,3})\s*-->\s*(?:(\d+):)?(\d{1,2}):(\d{2})[,.](\d{1,3})'
+)
+TRANSCRIPT_LINE_RE = re.compile(r'^\[?(?:(\d+):)?(\d{1,2}):(\d{2})(?:[,.](\d{1,3}))?\]?\s+(.+)$')
+SUBTITLE_TAG_RE = re.compile(r'<[^>]+>|\{\\[^}]*\}')
+SUBTITLE_BATCH_SIZE = 32
+
+def _subtitle_seconds(h, m, s, ms):
+    return int(h or 0) * 3600 + int(m) * 60 + int(s) + int((ms or '0').ljust(3, '0')) / 1000
+
+def iter_subtitle_cues(lines):
+    """
+    SRT / VTT / タイムスタンプ付き台本を1行ずつ読み、(開始秒, 終了秒, テキスト) を順に返す
+    """
+    start = end = None
+    buf = []
+    for raw in lines:
+        line = raw.strip().lstrip('\ufeff')
+        m = SUBTITLE_CUE_RE.search(line)
+        if m:
+            if start is not None and buf: yield start, end, ' '.join(buf)
+            g = m.groups()
+            start, end = _subtitle_seconds(*g[:4]), _subtitle_seconds(*g[4:])
+            buf = []
+            continue
+        if not line:
+            if start is not None and buf: yield start, end, ' '.join(buf)
+            start, buf = None, []
+            continue
+        if start is None:
+            # 「[00:01:23] セリフ」形式の台本行
+            t = TRANSCRIPT_LINE_RE.match(line)
+            if t:
+                sec = _subtitle_seconds(*t.groups()[:4])
+                text = SUBTITLE_TAG_RE.sub('', t.group(5)).strip()
+                if text: yield sec, sec, text
+            # それ以外 (連番, WEBVTTヘッダ, NOTE等) は読み飛ばす
+            continue
+        text = SUBTITLE_TAG_RE.sub('', line).strip()
+        if text: buf.append(text)
+    if start is not None and buf: yield start, end, ' '.join(buf)
+
+def window_cues(cues, window_sec=60, max_chars=600):
+    # 字幕を一定時間ごとのシーンにまとめる (保持するのは現在のウィンドウ分だけ)
+    win_start = None
+    texts, n_chars = [], 0
+    for start, _, text in cues:
+        if win_start is not None and (start >= win_start + window_sec or n_chars + len(text) > max_chars):
+            yield {"timestamp": win_start, "display_time": format_time(win_start),
+                   "plot": ' '.join(texts), "emotion_content": ""}
+            win_start, texts, n_chars = None, [], 0
+        if win_start is None: win_start = start
+        texts.append(text)
+        n_chars += len(text)
+    if texts:
+        yield {"timestamp": win_start, "display_time": format_time(win_start),
+               "plot": ' '.join(texts), "emotion_content": ""}
+
+def batched(iterable, n):
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, n)):
+        yield batch
+
+def prescore_scenes(scenes, batch_size=SUBTITLE_BATCH_SIZE):
+    # 台詞 (plot) を辞書で事前採点し、バッチ単位で返す
+    # 感情メモのスコアとは別物なので plot_dictionary_score として持ち、表示にだけ使う
+    for batch in batched(scenes, batch_size):
+        for scene in batch:
+            plot_score, _ = analyze_sentiment_advanced(scene['plot'])
+            scene["plot_dictionary_score"] = plot_score
+        yield batch
+
+def import_subtitle_file(binary_file, encoding='utf-8-sig', window_sec=60):
+    lines = io.TextIOWrapper(binary_file, encoding=encoding, errors='replace')
+    return prescore_scenes(window_cues(iter_subtitle_cues(lines), window_sec=window_sec))
+
+# --- HTMLレポート出力 ---
+
+REPORT_CURVE_MAX_POINTS = 600
+REPORT_CHUNK_ROWS = 200
+REPORT_SVG_WIDTH = 800
+REPORT_SVG_HEIGHT = 200
+REPORT_DIR = os.path.join(tempfile.gettempdir(), 'emotrace_reports')
+REPORT_MAX_AGE_SEC = 24 * 60 * 60
+
+def _cell_text(row, key):
+    val = row.get(key, '')
+    return str(val) if pd.notna(val) else ''
+
+def downsample_curve(values, max_points=REPORT_CURVE_MAX_POINTS):
+    # 区間ごとに最小値・最大値の点だけを残す (山と谷を潰さない間引き)
+    n = len(values)
+    if n <= max_points: return np.arange(n), values
+    edges = np.linspace(0, n, max_points // 2 + 1).astype(int)
+    idx = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        seg = values[lo:hi]
+        idx.extend(sorted({lo + int(np.argmin(seg)), lo + int(np.argmax(seg))}))
+    idx = np.array(idx)
+    return idx, values[idx]
+
+def curve_svg(df, width=REPORT_SVG_WIDTH, height=REPORT_SVG_HEIGHT):
+    # 感情曲線 (User / Story) を静的なSVGにする
+    duration = max(float(df['timestamp'].max()), 60)
+    pad = 24
+    def to_points(col):
+        scores = df[col] if col in df else np.zeros(len(df))
+        idx, vals = downsample_curve(decay_curve_array(df['timestamp'], scores, duration))
+        xs = pad + idx / duration * (width - 2 * pad)
+        ys = height / 2 - vals / 1.2 * (height / 2 - pad / 2)
+        return " ".join(f"{x:.1f},{y:.1f}" for x, y in zip(xs, ys))
+
+    minutes = duration / 60
+    step = max(1, int(math.ceil(minutes / 10)))
+    ticks = "".join(
+        f'<text x="{pad + m * 60 / duration * (width - 2 * pad):.1f}" y="{height - 4}" font-size="10" fill="#999" text-anchor="middle">{m}分</text>'
+        for m in range(0, int(minutes) + 1, step)
+    )
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {width} {height}" style="width:100%;max-width:{width}px;background:#fff;border:1px solid #eee;border-radius:4px;">'
+        f'<line x1="{pad}" y1="{height / 2}" x2="{width - pad}" y2="{height / 2}" stroke="#ddd"/>'
+        f'<polyline fill="none" stroke="#2c3e50" stroke-width="1.5" stroke-dasharray="4,4" opacity="0.7" points="{to_points("story_score")}"/>'
+        f'<polyline fill="none" stroke="#2a9d8f" stroke-width="2.5" points="{to_points("sentiment")}"/>'
+        f'{ticks}</svg>'
+    )
+
+def write_html_report(df, title, out, chunk_rows=REPORT_CHUNK_ROWS):
+    """
+    レポートを out (write() を持つオブジェクト) へ分割して書き出す
+    """
+    df_sorted = df.sort_values('timestamp').reset_index(drop=True)
+    n = len(df_sorted)
+    out.write(
+        "<html><head><meta charset='utf-8'></head>"
+        "<body style='font-family:sans-serif;padding:20px;background:#f9f9f9;'>"
+        f"<h2>{html.escape(title)} Analysis Report</h2>"
+        "<p style='font-size:0.85em;color:#666;'>緑の実線: あなたの感情スコア / 青の点線: 物語の状況スコア</p>"
+    )
+    out.write(curve_svg(df_sorted))
+
+    # 目次
+    out.write(f"<details style='margin:16px 0;'><summary style='cursor:pointer;font-weight:bold;'>目次 ({n}シーン)</summary><ol style='font-size:0.85em;'>")
+    for start in range(0, n, chunk_rows):
+        parts = []
+        for i, row in enumerate(df_sorted.iloc[start:start + chunk_rows].to_dict('records'), start):
+            plot_txt = _cell_text(row, 'plot')
+            short = plot_txt[:40] + ("…" if len(plot_txt) > 40 else "")
+            parts.append(f"<li><a href='#scene-{i}'>{html.escape(_cell_text(row, 'display_time'))}</a> {html.escape(short)}</li>")
+        out.write("".join(parts))
+    out.write("</ol></details>")
+
+    # シーン詳細
+    for start in range(0, n, chunk_rows):
+        parts = []
+        for i, row in enumerate(df_sorted.iloc[start:start + chunk_rows].to_dict('records'), start):
+            score = row['sentiment']
+            story = row.get('story_score', 0)
+            story = story if pd.notna(story) else 0.0
+            border_color = '#2a9d8f' if score >= 0.1 else '#e76f51' if score <= -0.1 else '#ccc'
+            parts.append(f"""
+        <div id="scene-{i}" style="border-left:4px solid {border_color}; background:#fff; padding:12px; margin-bottom:12px; border-radius:4px; box-shadow:0 1px 3px rgba(0,0,0,0.1);">
             <div style="font-size:0.85em; color:#666; font-family:monospace; margin-bottom:4px; display:flex; justify-content:space-between;">
-                <span>{row['display_time']}</span>
-                <strong style="color:#555;">User: {score:+.2f} / Story: {row.get('story_score', 0):+.2f}</strong>
+                <span>{html.escape(_cell_text(row, 'display_time'))}</span>
+                <strong style="color:#555;">User: {score:+.2f} / Story: {story:+.2f}</strong>
             </div>
             <div style="margin-bottom:6px;">
-                <span style="font-weight:bold; color:#333;">{html.escape(plot_txt)}</span>
+                <span style="font-weight:bold; color:#333;">{html.escape(_cell_text(row, 'plot'))}</span>
             </div>
             <div style="font-size:0.9em; color:#555;">
-                💭 {html.escape(emo_txt)}
+                💭 {html.escape(_cell_text(row, 'emotion_content'))}
             </div>
             <div style="margin-top:8px; font-size:0.85em; color:#444; border-top:1px dashed #eee; padding-top:4px;">
-                🤖 {html.escape(comment_txt)}
+                🤖 {html.escape(_cell_text(row, 'comment'))}
             </div>
-        </div>"""
-    
-    return f"<html><body style='font-family:sans-serif;padding:20px;background:#f9f9f9;'><h2>{html.escape(title)} Analysis Report</h2>{rows_html}</body></html>"
+        </div>""")
+        out.write("".join(parts))
+    out.write("</body></html>")
+
+def _cleanup_report_dir(max_age=REPORT_MAX_AGE_SEC):
+    # 期限切れのレポート (終了したセッションの残り) を削除する
+    now = time.time()
+    for name in os.listdir(REPORT_DIR):
+        path = os.path.join(REPORT_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > max_age: os.remove(path)
+        except OSError: pass
+
+def discard_report_file():
+    cache = st.session_state.get('report_cache')
+    if cache:
+        try: os.remove(cache['path'])
+        except OSError: pass
+    st.session_state.report_cache = None
+
+def get_report_file(df, title):
+    # アプリ専用の一時ディレクトリに書き出したレポートのパスを返す
+    # analyzed_notes の版数と作品名が変わったときだけ作り直す
+    key = (st.session_state.notes_version, title)
+    cache = st.session_state.report_cache
+    if cache and cache['key'] == key and os.path.exists(cache['path']):
+        return cache['path']
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    _cleanup_report_dir()
+    fd, path = tempfile.mkstemp(suffix='.html', dir=REPORT_DIR)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        write_html_report(df, title, f)
+    discard_report_file()
+    st.session_state.report_cache = {'key': key, 'path': path}
+    return path
 
 # =========================================================
 # 4. メインUI
@@ -517,6 +1142,7 @@ with st.sidebar:
                     restored_notes = df_restore.to_dict('records')
                     st.session_state.notes = restored_notes
                     st.session_state.analyzed_notes = restored_notes
+                    st.session_state.notes_version += 1
                     
                     # 状態を分析完了に
                     st.session_state.status = 'finished'
@@ -542,21 +1168,119 @@ with st.sidebar:
                 st.error(f"読み込みエラー: {e}")
 
     with st.expander("📂 過去データの比較"):
-        uploaded_file = st.file_uploader("CSVファイル", type=["csv"], key="compare_csv")
-        if uploaded_file:
+        uploaded_files = st.file_uploader(
+            "CSVファイル (複数可)", type=["csv"], accept_multiple_files=True,
+            key=f"compare_csv_{st.session_state.compare_uploader_gen}"
+        )
+        # アップローダーの現在のファイル一覧から作り直す (外したファイルは比較から消える)
+        current_logs = {}
+        for uploaded_file in uploaded_files or []:
+            log_key = f"{uploaded_file.name}:{uploaded_file.size}"
+            if log_key in current_logs: continue
+            if log_key in st.session_state.compare_logs:
+                current_logs[log_key] = st.session_state.compare_logs[log_key]
+                continue
             try:
                 compare_df = pd.read_csv(uploaded_file)
-                st.session_state.compare_data = compare_df
-                st.session_state.compare_title = uploaded_file.name
-                st.success(f"『{st.session_state.compare_title}』読込完了")
-            except: st.error("読込エラー")
+                if 'timestamp' not in compare_df or 'sentiment' not in compare_df or compare_df.empty:
+                    st.error(f"『{uploaded_file.name}』に timestamp / sentiment 列がありません")
+                    continue
+                current_logs[log_key] = {'title': uploaded_file.name, 'df': compare_df}
+            except: st.error(f"『{uploaded_file.name}』読込エラー")
+        st.session_state.compare_logs = current_logs
+        if st.session_state.compare_logs:
+            st.success(f"{len(st.session_state.compare_logs)}件のログを読込済み")
         if st.button("比較クリア"):
-            st.session_state.compare_data = None
-            st.session_state.compare_title = ""
+            st.session_state.compare_logs = {}
+            st.session_state.compare_uploader_gen += 1
             st.rerun()
 
+    with st.expander("🎞️ 字幕・台本の取り込み"):
+        st.caption("SRT / VTT / タイムスタンプ付き台本を一定時間ごとのシーンに分け、プロットとして一括登録します。")
+        sub_file = st.file_uploader("字幕ファイル", type=["srt", "vtt", "txt"], key=f"subtitle_file_{st.session_state.subtitle_uploader_gen}")
+        c_win, c_enc = st.columns(2)
+        sub_window = c_win.slider("シーンの長さ (秒)", 15, 300, 60, 15)
+        sub_enc = c_enc.selectbox("文字コード", ["utf-8-sig", "shift-jis", "cp932"])
+        if sub_file and st.button("シーンとして取り込む"):
+            imported = []
+            progress_txt = st.empty()
+            try:
+                for batch in import_subtitle_file(sub_file, encoding=sub_enc, window_sec=sub_window):
+                    imported.extend(batch)
+                    progress_txt.text(f"辞書で事前採点中... ({len(imported)}シーン)")
+                progress_txt.empty()
+                # 既に登録済みのシーン (同じ時刻・同じ本文) は重複させない
+                existing = {(n['timestamp'], n['plot']) for n in st.session_state.notes}
+                new_scenes = [n for n in imported if (n['timestamp'], n['plot']) not in existing]
+                if new_scenes:
+                    st.session_state.notes = sorted(st.session_state.notes + new_scenes, key=lambda n: n['timestamp'])
+                    if st.session_state.status == 'ready': st.session_state.status = 'paused'
+                    # 取り込み後はアップローダーを空にし、再クリックでの二重登録を防ぐ
+                    st.session_state.subtitle_uploader_gen += 1
+                    st.success(f"{len(new_scenes)}シーンを取り込みました")
+                    time.sleep(1)
+                    st.rerun()
+                elif imported:
+                    st.info("すべてのシーンが登録済みです")
+                else:
+                    st.warning("字幕が見つかりませんでした")
+            except Exception as e:
+                st.error(f"取り込みエラー: {e}")
+
+    with st.expander("📚 ユーザー辞書"):
+        st.caption(f"読込済み: {', '.join(LOADED_DICTS) if LOADED_DICTS else '内蔵辞書'} / ユーザー登録: {len(SENTIMENT_INDEX['overlay'])}語")
+        with st.form("user_dict_form", clear_on_submit=True):
+            ud_term = st.text_input("語 (基本形)", placeholder="例: 神回")
+            c_pos, c_sc = st.columns(2)
+            ud_pos = c_pos.selectbox("品詞", [POS_ANY] + POS_CLASSES, format_func=lambda p: "指定なし" if p == POS_ANY else p)
+            ud_score = c_sc.number_input("スコア (0で無効化)", -1.0, 1.0, 1.0, 0.1)
+            if st.form_submit_button("登録") and ud_term.strip():
+                try:
+                    add_user_dict_entry(SENTIMENT_INDEX, ud_term, ud_score, ud_pos)
+                    st.success(f"「{ud_term.strip()}」を登録しました")
+                except ValueError as e:
+                    st.error(f"登録エラー: {e}")
+        if st.button(f"{USER_DICT_FILE} を再読込"):
+            reload_user_overlay(SENTIMENT_INDEX, force=True)
+            st.rerun()
+
+    with st.expander("⚡ ローカル推定 (API節約)"):
+        st.caption("AI分析済みのログ(CSV)から推定モデルを学習し、辞書判定が明瞭なシーンはAPIを呼ばずに採点します。")
+        train_files = st.file_uploader("学習用ログ(CSV)", type=["csv"], accept_multiple_files=True, key="local_train_csv")
+        if train_files and st.button("推定モデルを学習"):
+            try:
+                df_train = pd.concat([pd.read_csv(f) for f in train_files], ignore_index=True)
+                with st.spinner("特徴量を抽出中..."):
+                    X_tr, Y_tr, clarity_tr = build_local_training_set(df_train)
+                if len(X_tr) < LOCAL_MIN_TRAIN_ROWS:
+                    st.warning(f"AIスコア付きの行が不足しています ({len(X_tr)}/{LOCAL_MIN_TRAIN_ROWS})")
+                else:
+                    st.session_state.local_scorer = fit_local_scorer(X_tr, Y_tr, clarity_tr)
+                    st.session_state.local_scorer_report = local_scorer_report(X_tr, Y_tr, clarity_tr)
+                    st.session_state.local_scorer_enabled = True
+                    st.success(f"{len(X_tr)}件で学習しました")
+            except Exception as e:
+                st.error(f"学習エラー: {e}")
+
+        if st.session_state.local_scorer is not None:
+            st.session_state.local_scorer_enabled = st.checkbox("ローカル推定を使う", value=st.session_state.local_scorer_enabled)
+            st.session_state.local_threshold = st.slider("信頼度の閾値", 0.0, 1.0, st.session_state.local_threshold, 0.05)
+            report = st.session_state.local_scorer_report
+            if report is not None:
+                st.caption("交差検証 (学習に使っていない行) での評価")
+                st.dataframe(report.style.format({
+                    "閾値": "{:.1f}", "API削減率": "{:.0%}", "MAE(user)": "{:.2f}",
+                    "MAE(story)": "{:.2f}", "符号一致率(user)": "{:.0%}"
+                }), hide_index=True, use_container_width=True)
+            if st.button("推定モデルを破棄"):
+                st.session_state.local_scorer = None
+                st.session_state.local_scorer_report = None
+                st.session_state.local_scorer_enabled = False
+                st.rerun()
+
     st.divider()
     if st.button("🗑️ 新規作成 (リセット)", use_container_width=True):
+        discard_report_file()
         for key in list(st.session_state.keys()):
             del st.session_state[key]
         st.rerun()
@@ -588,24 +1312,31 @@ with c4:
             progress = st.progress(0)
             status_txt = st.empty()
             analyzed_data = []
-            
+            local_count = 0
+            prev_used_api = False
+
             total = len(st.session_state.notes)
             for i, note in enumerate(st.session_state.notes):
                 status_txt.text(f"シーン解析中... ({i+1}/{total})")
-                if i > 0: time.sleep(0.5) # レート制限対策で少し待機
-                
-                user_sc, story_sc, rsn, log, dict_sc = analyze_scene_with_ai(note['plot'], note['emotion_content'])
+                if prev_used_api: time.sleep(0.5) # レート制限対策で少し待機
+
+                user_sc, story_sc, rsn, log, dict_sc, sent_sc = analyze_scene_with_ai(note['plot'], note['emotion_content'])
+                is_local = rsn.startswith(LOCAL_COMMENT_PREFIX)
+                local_count += is_local
+                prev_used_api = bool(st.session_state.gemini_api_key) and not is_local
                 new_note = note.copy()
                 new_note.update({
                     "sentiment": user_sc, 
                     "story_score": story_sc,
                     "comment": rsn, 
-                    "calc_log": log, "dictionary_score": dict_sc 
+                    "calc_log": log, "dictionary_score": dict_sc,
+                    "sentence_scores": sent_sc
                 })
                 analyzed_data.append(new_note)
                 progress.progress((i + 1) / total)
             
             st.session_state.analyzed_notes = analyzed_data
+            st.session_state.notes_version += 1
             
             # 全体構造分析の生成
             if st.session_state.gemini_api_key:
@@ -617,6 +1348,8 @@ with c4:
             status_txt.empty()
             progress.empty()
             st.toast("分析完了。物語の構造を紐解きます。", icon="📝")
+            if local_count:
+                st.toast(f"ローカル推定で {local_count}/{total} 件のAPI呼び出しを省略しました", icon="⚡")
         
         st.rerun()
 
@@ -659,6 +1392,8 @@ if st.session_state.status in ['playing', 'paused']:
                     # 変更を即時反映
                     if new_plot != note['plot']:
                         st.session_state.notes[i]['plot'] = new_plot
+                        # 字幕取り込み時の事前スコアは本文が変わったら破棄
+                        st.session_state.notes[i].pop('plot_dictionary_score', None)
                     if new_emo != note['emotion_content']:
                         st.session_state.notes[i]['emotion_content'] = new_emo
                 st.divider()
@@ -705,22 +1440,56 @@ if st.session_state.status == 'finished':
             alt.datum.Type == 'Story Tone'
         ).mark_line(color='#2c3e50', strokeDash=[4, 4], size=2, opacity=0.7)
         
-        # 過去データ比較があれば追加
         layers = [line_story, line_user]
-        
-        if st.session_state.compare_data is not None:
-            max_t_comp = st.session_state.compare_data['timestamp'].max()
-            df_comp_decay = calculate_decay_curve(st.session_state.compare_data, max(max_time, max_t_comp), target_col='sentiment')
-            df_comp_decay['Minutes'] = df_comp_decay['timestamp'] / 60
-            
-            comp_line = alt.Chart(df_comp_decay).mark_line(color='#aaa', strokeDash=[2,2]).encode(
-                x='Minutes',
-                y='score',
-                tooltip=[alt.Tooltip('score', title='Compare Score')]
+        st.altair_chart(alt.layer(*layers).interactive(), use_container_width=True)
+
+        # 過去データとの比較 (進行度で正規化した複数ログ)
+        if st.session_state.compare_logs:
+            st.subheader("📈 過去データとの比較")
+            c_mode, c_band, c_lines = st.columns([2, 2, 1])
+            align_mode = c_mode.radio(
+                "時間軸の揃え方", ["normalized", "dtw"], horizontal=True,
+                format_func=lambda m: "進行度で正規化" if m == "normalized" else "DTWで整列"
             )
-            layers.insert(0, comp_line) # 最背面に
+            band_ratio = c_band.slider("DTWの探索幅 (%)", 2, 30, 10, disabled=(align_mode != "dtw")) / 100
+            show_each = c_lines.checkbox("個別の曲線", value=False)
 
-        st.altair_chart(alt.layer(*layers).interactive(), use_container_width=True)
+            compare_items = list(st.session_state.compare_logs.values())
+            curves = np.vstack([normalized_curve(item['df']) for item in compare_items])
+            reference = normalized_curve(df)
+            aligned, bands, similarity = compare_log_curves(curves, reference, align_mode, band_ratio)
+
+            band_outer = alt.Chart(bands).mark_area(color='#aaa', opacity=0.15).encode(
+                x=alt.X('progress', title='進行度 (%)'),
+                y=alt.Y('p10', title='スコア', scale=alt.Scale(domain=[-1.2, 1.2])), y2='p90'
+            )
+            band_inner = alt.Chart(bands).mark_area(color='#888', opacity=0.25).encode(x='progress', y='p25', y2='p75')
+            mean_line = alt.Chart(bands).mark_line(color='#555', strokeDash=[4, 2]).encode(
+                x='progress', y='mean', tooltip=[alt.Tooltip('progress', format='.0f'), alt.Tooltip('mean', format='+.2f')]
+            )
+            df_ref = pd.DataFrame({'progress': bands['progress'], 'score': reference})
+            ref_line = alt.Chart(df_ref).mark_line(color='#2a9d8f', size=3).encode(x='progress', y='score')
+            comp_layers = [band_outer, band_inner, mean_line, ref_line]
+
+            if show_each:
+                df_each = pd.DataFrame({
+                    'progress': np.tile(bands['progress'].to_numpy(), len(compare_items)),
+                    'score': aligned.ravel(),
+                    'log': np.repeat([item['title'] for item in compare_items], aligned.shape[1]),
+                })
+                each_lines = alt.Chart(df_each).mark_line(opacity=0.4, size=1).encode(
+                    x='progress', y='score', color=alt.Color('log', legend=None), tooltip=['log']
+                )
+                comp_layers.insert(2, each_lines)
+
+            st.caption("緑: 今回のログ / 破線: 比較ログの平均 / 帯: 25〜75% (濃) と 10〜90% (淡) の範囲")
+            st.altair_chart(alt.layer(*comp_layers).interactive(), use_container_width=True)
+
+            similarity.insert(0, 'ログ', [item['title'] for item in compare_items])
+            st.dataframe(
+                similarity.sort_values('類似度', ascending=False).style.format({'相関': '{:+.2f}', '距離': '{:.3f}', '類似度': '{:.0%}'}),
+                hide_index=True, use_container_width=True
+            )
 
         # 2. タイムライン
         st.subheader("2. シーン詳細と構造解析")
@@ -740,6 +1509,10 @@ if st.session_state.status == 'finished':
             plot_txt = str(row.get('plot', '')) if pd.notna(row.get('plot', '')) else ''
             emo_txt = str(row.get('emotion_content', '')) if pd.notna(row.get('emotion_content', '')) else ''
             comment_txt = str(row.get('comment', '')) if pd.notna(row.get('comment', '')) else ''
+            strip_html = sentence_strip_html(parse_logged_list(row.get('sentence_scores')))
+            # 字幕取り込みシーンは台詞の辞書スコアを参考表示
+            plot_dsc = row.get('plot_dictionary_score', np.nan)
+            plot_dsc_html = f'<span style="margin-right:10px;">台詞: {plot_dsc:+.2f}</span>' if pd.notna(plot_dsc) else ''
             
             tl_html += f"""
             <div class="timeline-item">
@@ -747,11 +1520,13 @@ if st.session_state.status == 'finished':
                 <div class="timeline-marker {cls}"></div>
                 <div class="timeline-content {b_cls}">
                     <div style="display:flex; justify-content:flex-end; align-items:center; margin-bottom:4px; font-size:0.8em; color:#666;">
+                        {plot_dsc_html}
                         <span style="margin-right:10px;">Story: <strong style="color:{ssc_color};">{ssc:+.2f}</strong></span>
                         <span>User: <strong>{sc:+.2f}</strong></span>
                     </div>
                     <div style="font-size:0.95em; font-weight:bold; margin-bottom:4px;">{html.escape(plot_txt)}</div>
                     <div style="font-size:0.9em; color:#666; font-style:italic; margin-bottom:8px;">💭 {html.escape(emo_txt)}</div>
+                    {strip_html}
                     <div style="font-size:0.85em; color:#333; background:#f9f9f9; padding:6px; border-radius:4px;">
                         🤖 {html.escape(comment_txt)}
                     </div>
@@ -761,10 +1536,11 @@ if st.session_state.status == 'finished':
         
         # ダウンロード
         csv = df.to_csv(index=False).encode('utf-8-sig')
-        html_rep = generate_html_report(df, work_title if work_title else "Analysis").encode('utf-8')
+        report_path = get_report_file(df, work_title if work_title else "Analysis")
         c_d1, c_d2 = st.columns(2)
         c_d1.download_button("CSV保存", csv, "log.csv", "text/csv")
-        c_d2.download_button("レポート保存", html_rep, "report.html", "text/html")
+        with open(report_path, 'rb') as report_file:
+            c_d2.download_button("レポート保存", report_file, "report.html", "text/html")
 
     # 3. 構造分析チャット
     st.divider()